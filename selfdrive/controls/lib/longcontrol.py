@@ -1,5 +1,5 @@
 from cereal import car, log
-from common.numpy_fast import clip, interp
+from common.numpy_fast import interp
 from common.realtime import DT_CTRL
 from selfdrive.controls.lib.pid import LongPIDController
 from selfdrive.controls.lib.drive_helpers import CONTROL_N
@@ -20,46 +20,99 @@ STOPPING_TARGET_SPEED_OFFSET = 0.01
 ACCEL_MIN_ISO = -3.5 # m/s^2
 ACCEL_MAX_ISO = 2.0 # m/s^2
 
+_T_IDXS_CONTROL = tuple(T_IDXS[:CONTROL_N])
 
-def long_control_state_trans(CP, active, long_control_state, v_ego, v_target, v_pid,
-                             output_accel, brake_pressed, cruise_standstill, min_speed_can, stop, gas_pressed):
-  """Update longitudinal control state machine"""
-  stopping_target_speed = min_speed_can + STOPPING_TARGET_SPEED_OFFSET
+
+_OFF = int(LongCtrlState.off)
+_PID = int(LongCtrlState.pid)
+_STOPPING = int(LongCtrlState.stopping)
+_STARTING = int(LongCtrlState.starting)
+
+
+def _lerp_coeffs(bp, v):
+  """Precompute (bp0, bp1, v0, slope, v1) of a one or two point interp table"""
+  if len(bp) == 1:
+    return bp[0], bp[0], v[0], 0., v[0]
+  return bp[0], bp[1], v[0], (v[1] - v[0]) / (bp[1] - bp[0]), v[1]
+
+
+def _state_trans(active, long_control_state, v_ego, v_target, v_pid, output_accel, brake_pressed,
+                 cruise_standstill, stop, gas_pressed, stopping_target_speed, v_ego_stopping, v_ego_starting, start_accel):
+  """Longitudinal state machine on plain scalars, states are passed as ints"""
   stopping_condition = stop or (v_ego < 2.0 and cruise_standstill) or \
-                       (v_ego < CP.vEgoStopping and
+                       (v_ego < v_ego_stopping and
                         ((v_pid < stopping_target_speed and v_target < stopping_target_speed) or
                          brake_pressed))
 
-  starting_condition = v_target > CP.vEgoStarting and not cruise_standstill or gas_pressed
+  starting_condition = v_target > v_ego_starting and not cruise_standstill or gas_pressed
 
   if not active:
-    long_control_state = LongCtrlState.off
+    long_control_state = _OFF
 
   else:
-    if long_control_state == LongCtrlState.off:
-      if active:
-        long_control_state = LongCtrlState.pid
+    if long_control_state == _OFF:
+      long_control_state = _PID
 
-    elif long_control_state == LongCtrlState.pid:
+    elif long_control_state == _PID:
       if stopping_condition:
-        long_control_state = LongCtrlState.stopping
+        long_control_state = _STOPPING
 
-    elif long_control_state == LongCtrlState.stopping:
+    elif long_control_state == _STOPPING:
       if starting_condition:
-        long_control_state = LongCtrlState.starting
+        long_control_state = _STARTING
 
-    elif long_control_state == LongCtrlState.starting:
+    elif long_control_state == _STARTING:
       if stopping_condition:
-        long_control_state = LongCtrlState.stopping
-      elif output_accel >= CP.startAccel:
-        long_control_state = LongCtrlState.pid
+        long_control_state = _STOPPING
+      elif output_accel >= start_accel:
+        long_control_state = _PID
 
   return long_control_state
 
 
+def long_control_state_trans(CP, active, long_control_state, v_ego, v_target, v_pid,
+                             output_accel, brake_pressed, cruise_standstill, stopping_target_speed, stop, gas_pressed):
+  """Update longitudinal control state machine"""
+  return _state_trans(active, long_control_state, v_ego, v_target, v_pid, output_accel, brake_pressed,
+                      cruise_standstill, stop, gas_pressed, stopping_target_speed,
+                      CP.vEgoStopping, CP.vEgoStarting, CP.startAccel)
+
+
+class _CPSnapshot():
+  """Plain copy of the CarParams fields read by LongControl on every tick"""
+  __slots__ = ('longitudinalActuatorDelayLowerBound', 'longitudinalActuatorDelayUpperBound',
+               'vEgoStopping', 'vEgoStarting', 'startAccel', 'stopAccel', 'stoppingDecelStep',
+               'startingAccelStep', 'stoppingTargetSpeed', 'stoppingControl', 'sccBus', 'deadzoneBP', 'deadzoneV')
+
+  def __init__(self, CP):
+    self.longitudinalActuatorDelayLowerBound = float(CP.longitudinalActuatorDelayLowerBound)
+    self.longitudinalActuatorDelayUpperBound = float(CP.longitudinalActuatorDelayUpperBound)
+    self.vEgoStopping = float(CP.vEgoStopping)
+    self.vEgoStarting = float(CP.vEgoStarting)
+    self.startAccel = float(CP.startAccel)
+    self.stopAccel = float(CP.stopAccel)
+    self.stoppingDecelStep = float(CP.stoppingDecelRate) * DT_CTRL  # per tick
+    self.startingAccelStep = float(CP.startingAccelRate) * DT_CTRL  # per tick
+    self.stoppingTargetSpeed = float(CP.minSpeedCan) + STOPPING_TARGET_SPEED_OFFSET
+    self.stoppingControl = bool(CP.stoppingControl)
+    self.sccBus = int(CP.sccBus)
+    self.deadzoneBP = tuple(CP.longitudinalTuning.deadzoneBP)
+    self.deadzoneV = tuple(CP.longitudinalTuning.deadzoneV)
+
+
 class LongControl():
+  _STAT_MAP = {_STOPPING: "STP", _STARTING: "STR", _PID: "PID", _OFF: "OFF"}
+  _SRC_MAP = {int(LongitudinalPlanSource.cruise): "cruise", int(LongitudinalPlanSource.lead0): "lead0",
+              int(LongitudinalPlanSource.lead1): "lead1", int(LongitudinalPlanSource.lead2): "lead2",
+              int(LongitudinalPlanSource.e2e): "e2e"}
+
+  __slots__ = ('long_control_state', '_cp', 'pid', 'v_pid', 'last_output_accel',
+               'long_stat', 'long_plan_source', '_last_log_sig', '_long_log_line', 'candidate', 'long_log', '_damp', 'loc_timer',
+               '_deadzone', '_stopping_factor', '_starting_factor', '_decel_damping2')
+
   def __init__(self, CP, candidate):
-    self.long_control_state = LongCtrlState.off  # initialized to off
+    self.long_control_state = _OFF  # initialized to off, stored as a plain int
+    self._cp = _CPSnapshot(CP)  # CP does not change during a drive, aqValue is read live
 
     self.pid = LongPIDController((CP.longitudinalTuning.kpBP, CP.longitudinalTuning.kpV),
                                  (CP.longitudinalTuning.kiBP, CP.longitudinalTuning.kiV),
@@ -71,17 +124,31 @@ class LongControl():
     self.last_output_accel = 0.0
     self.long_stat = ""
     self.long_plan_source = ""
+    self._last_log_sig = None  # forces the first long log line to be built
+    self._long_log_line = ""
 
     self.candidate = candidate
     self.long_log = Params().get_bool("LongLogDisplay")
 
-    self.vRel_prev = 0
-    self.decel_damping = 1.0
-    self.decel_damping2 = 1.0
-    self.damping_timer3 = 1.0
-    self.damping_timer = 0
+    # opkr decel damping state: vRel_prev, decel_damping, decel_damping2, damping_timer, damping_timer3
+    self._damp = [0., 1., 1., 0., 1.]
     self.loc_timer = 0 
 
+    # constant interp tables, evaluated with _lerp2
+    self._deadzone = _lerp_coeffs(self._cp.deadzoneBP, self._cp.deadzoneV) if len(self._cp.deadzoneBP) <= 2 else None
+    self._stopping_factor = _lerp_coeffs([2.0, 5.5], [6.0, 1.0])
+    self._starting_factor = _lerp_coeffs([5.5, 6.5], [1.0, 2.0])
+    self._decel_damping2 = _lerp_coeffs([0., 5.], [1., 0.])
+
+  @staticmethod
+  def _lerp2(x, bp0, bp1, v0, slope, v1):
+    """Same as interp(x, [bp0, bp1], [v0, v1]) with the slope precomputed"""
+    if x <= bp0:
+      return v0
+    elif x >= bp1:
+      return v1
+    return v0 + (x - bp0) * slope
+
   def reset(self, v_pid):
     """Reset PID controller and change setpoint"""
     self.pid.reset()
@@ -92,144 +159,155 @@ class LongControl():
     if self.loc_timer > 100:
       self.loc_timer = 0
       self.long_log = Params().get_bool("LongLogDisplay")
+      self._last_log_sig = None
     """Update longitudinal control. This updates the state machine and runs a PID loop"""
+    cp = self._cp
+    # read the capnp fields once, everything below works on plain scalars
+    v_ego = CS.vEgo
+    brake_pressed = CS.brakePressed
+    gas_pressed = CS.gasPressed
+    cruise_standstill = CS.cruiseState.standstill
     # Interp control trajectory
     # TODO estimate car specific lag, use .15s for now
     if len(long_plan.speeds) == CONTROL_N:
-      v_target_lower = interp(CP.longitudinalActuatorDelayLowerBound, T_IDXS[:CONTROL_N], long_plan.speeds)
-      a_target_lower = 2 * (v_target_lower - long_plan.speeds[0])/CP.longitudinalActuatorDelayLowerBound - long_plan.accels[0]
+      # copy the capnp list once, interp and the indexing below read it several times
+      speeds = list(long_plan.speeds)
+      a_plan = long_plan.accels[0]
+      v_target_lower = interp(cp.longitudinalActuatorDelayLowerBound, _T_IDXS_CONTROL, speeds)
+      a_target_lower = 2 * (v_target_lower - speeds[0])/cp.longitudinalActuatorDelayLowerBound - a_plan
 
-      v_target_upper = interp(CP.longitudinalActuatorDelayUpperBound, T_IDXS[:CONTROL_N], long_plan.speeds)
-      a_target_upper = 2 * (v_target_upper - long_plan.speeds[0])/CP.longitudinalActuatorDelayUpperBound - long_plan.accels[0]
+      v_target_upper = interp(cp.longitudinalActuatorDelayUpperBound, _T_IDXS_CONTROL, speeds)
+      a_target_upper = 2 * (v_target_upper - speeds[0])/cp.longitudinalActuatorDelayUpperBound - a_plan
 
       v_target = min(v_target_lower, v_target_upper)
       a_target = min(a_target_lower, a_target_upper)
 
-      v_target_future = long_plan.speeds[-1]
+      v_target_future = speeds[-1]
     else:
       v_target = 0.0
       v_target_future = 0.0
       a_target = 0.0
 
     # TODO: This check is not complete and needs to be enforced by MPC
-    a_target = clip(a_target, ACCEL_MIN_ISO, ACCEL_MAX_ISO)
+    a_target = ACCEL_MIN_ISO if a_target < ACCEL_MIN_ISO else (ACCEL_MAX_ISO if a_target > ACCEL_MAX_ISO else a_target)
 
-    self.pid.neg_limit = accel_limits[0]
-    self.pid.pos_limit = accel_limits[1]
+    accel_min, accel_max = accel_limits
+    self.pid.neg_limit = accel_min
+    self.pid.pos_limit = accel_max
 
     # Update state machine
     output_accel = self.last_output_accel
 
-    if radarState is None:
+    lead = None if radarState is None else radarState.leadOne
+    if lead is None:
       dRel = 150
       vRel = 0
     else:
-      dRel = radarState.leadOne.dRel
-      vRel = radarState.leadOne.vRel
-    if long_plan.hasLead:
+      dRel = lead.dRel
+      vRel = lead.vRel
+    has_lead = long_plan.hasLead
+    if has_lead:
       if CS.radarDistance <= 149:
-        stop = True if (dRel <= 3.5 and radarState.leadOne.status) else False
+        stop = True if (dRel <= 3.5 and lead is not None and lead.status) else False
         radar_target_detected = True
       else:
-        stop = True if (dRel < 5.5 and radarState.leadOne.status) else False
+        stop = True if (dRel < 5.5 and lead is not None and lead.status) else False
         radar_target_detected = False
     else:
       stop = False
       radar_target_detected = False
-    self.long_control_state = long_control_state_trans(CP, active, self.long_control_state, CS.vEgo,
-                                                       v_target_future, self.v_pid, output_accel,
-                                                       CS.brakePressed, CS.cruiseState.standstill, CP.minSpeedCan, stop, CS.gasPressed)
+    if not active:
+      # the state machine always goes to off when inactive, skip it
+      self.long_control_state = _OFF
+    else:
+      self.long_control_state = long_control_state_trans(cp, active, self.long_control_state, v_ego,
+                                                         v_target_future, self.v_pid, output_accel,
+                                                         brake_pressed, cruise_standstill, cp.stoppingTargetSpeed, stop, gas_pressed)
 
     #v_ego_pid = max(CS.vEgo, CP.minSpeedCan)  # Without this we get jumps, CAN bus reports 0 when speed < 0.3
-    v_ego_pid = max(CS.vEgo, 0.) # Neokii
+    v_ego_pid = max(v_ego, 0.) # Neokii
 
-    if (self.long_control_state == LongCtrlState.off or (CS.brakePressed or CS.gasPressed)) and self.candidate not in [CAR.NIRO_EV]:
+    if (self.long_control_state == _OFF or (brake_pressed or gas_pressed)) and self.candidate not in [CAR.NIRO_EV]:
       self.v_pid = v_ego_pid
       self.pid.reset()
       output_accel = 0.
-    elif self.long_control_state == LongCtrlState.off or CS.gasPressed:
+    elif self.long_control_state == _OFF or gas_pressed:
       self.reset(v_ego_pid)
       output_accel = 0.
 
     # tracking objects and driving
-    elif self.long_control_state == LongCtrlState.pid:
+    elif self.long_control_state == _PID:
       self.v_pid = v_target
 
       # Toyota starts braking more when it thinks you want to stop
       # Freeze the integrator so we don't accelerate to compensate, and don't allow positive acceleration
-      prevent_overshoot = not CP.stoppingControl and CS.vEgo < 1.5 and v_target_future < 0.7
-      deadzone = interp(v_ego_pid, CP.longitudinalTuning.deadzoneBP, CP.longitudinalTuning.deadzoneV)
+      prevent_overshoot = not cp.stoppingControl and v_ego < 1.5 and v_target_future < 0.7
+      if self._deadzone is not None:
+        deadzone = self._lerp2(v_ego_pid, *self._deadzone)
+      else:
+        deadzone = interp(v_ego_pid, cp.deadzoneBP, cp.deadzoneV)
       freeze_integrator = prevent_overshoot
 
       # opkr
-      if self.vRel_prev != vRel and vRel <= 0 and CS.vEgo > 13. and self.damping_timer <= 0: # decel mitigation for a while
-        if (vRel - self.vRel_prev)*3.6 <= -5:
-          self.damping_timer = 2.5*CS.vEgo
-          self.damping_timer3 = self.damping_timer
-          self.decel_damping2 = interp(abs((vRel - self.vRel_prev)*3.6), [0., 5.], [1., 0.])
-        self.vRel_prev = vRel
-      elif self.damping_timer > 0:
-        self.damping_timer -= 1
-        self.decel_damping = interp(self.damping_timer, [0., self.damping_timer3], [1., self.decel_damping2])
-
-      output_accel = self.pid.update(self.v_pid, v_ego_pid, speed=v_ego_pid, deadzone=deadzone, feedforward=a_target, freeze_integrator=freeze_integrator)
-      output_accel *= self.decel_damping
+      damp = self._damp
+      vrel_prev, decel_damping, decel_damping2, damping_timer, damping_timer3 = damp
+      if vrel_prev != vRel and vRel <= 0 and v_ego > 13. and damping_timer <= 0: # decel mitigation for a while
+        if (vRel - vrel_prev)*3.6 <= -5:
+          damping_timer = 2.5*v_ego
+          damping_timer3 = damping_timer
+          decel_damping2 = self._lerp2(abs((vRel - vrel_prev)*3.6), *self._decel_damping2)
+        vrel_prev = vRel
+      elif damping_timer > 0:
+        damping_timer -= 1
+        # interp(damping_timer, [0., damping_timer3], [1., decel_damping2]), damping_timer never exceeds damping_timer3
+        decel_damping = damping_timer * (decel_damping2 - 1.) / damping_timer3 + 1. if damping_timer > 0 else 1.
+      damp[:] = (vrel_prev, decel_damping, decel_damping2, damping_timer, damping_timer3)
+
+      output_accel = self.pid.update(v_target, v_ego_pid, speed=v_ego_pid, deadzone=deadzone, feedforward=a_target, freeze_integrator=freeze_integrator)
+      output_accel *= decel_damping
 
       if prevent_overshoot or CS.brakeHold:
         output_accel = min(output_accel, 0.0)
 
     # Intention is to stop, switch to a different brake control until we stop
-    elif self.long_control_state == LongCtrlState.stopping:
+    elif self.long_control_state == _STOPPING:
       # Keep applying brakes until the car is stopped
       factor = 1
-      if long_plan.hasLead:
-        factor = interp(dRel,[2.0,5.5], [6.0,1.0]) if not radar_target_detected else 1
-      if not CS.standstill or output_accel > CP.stopAccel:
-        output_accel -= CP.stoppingDecelRate * DT_CTRL * factor
-      elif CS.cruiseState.standstill and output_accel < CP.stopAccel:
-        output_accel += CP.stoppingDecelRate * DT_CTRL
-      output_accel = clip(output_accel, accel_limits[0], accel_limits[1])
+      if has_lead:
+        factor = self._lerp2(dRel, *self._stopping_factor) if not radar_target_detected else 1
+      if not CS.standstill or output_accel > cp.stopAccel:
+        output_accel -= cp.stoppingDecelStep * factor
+      elif cruise_standstill and output_accel < cp.stopAccel:
+        output_accel += cp.stoppingDecelStep
+      # clip before storing, so the stopping ramp can't wind up past the limits
+      output_accel = accel_min if output_accel < accel_min else (accel_max if output_accel > accel_max else output_accel)
 
-      self.reset(CS.vEgo)
+      self.reset(v_ego)
 
     # Intention is to move again, release brake fast before handing control to PID
-    elif self.long_control_state == LongCtrlState.starting:
+    elif self.long_control_state == _STARTING:
       factor = 1
-      if long_plan.hasLead:
-        factor = interp(dRel,[5.5,6.5], [1.0,2.0]) if not radar_target_detected else 1
-      if output_accel < CP.startAccel:
-        output_accel += CP.startingAccelRate * DT_CTRL * factor
-      self.reset(CS.vEgo)
+      if has_lead:
+        factor = self._lerp2(dRel, *self._starting_factor) if not radar_target_detected else 1
+      if output_accel < cp.startAccel:
+        output_accel += cp.startingAccelStep * factor
+      self.reset(v_ego)
 
+    # the starting ramp is stored unclipped, so it can still reach startAccel when accel_max is below it
     self.last_output_accel = output_accel
-    final_accel = clip(output_accel, accel_limits[0], accel_limits[1])
-
-    if self.long_control_state == LongCtrlState.stopping:
-      self.long_stat = "STP"
-    elif self.long_control_state == LongCtrlState.starting:
-      self.long_stat = "STR"
-    elif self.long_control_state == LongCtrlState.pid:
-      self.long_stat = "PID"
-    elif self.long_control_state == LongCtrlState.off:
-      self.long_stat = "OFF"
-    else:
-      self.long_stat = "---"
-
-    if long_plan.longitudinalPlanSource == LongitudinalPlanSource.cruise:
-      self.long_plan_source = "cruise"
-    elif long_plan.longitudinalPlanSource == LongitudinalPlanSource.lead0:
-      self.long_plan_source = "lead0"
-    elif long_plan.longitudinalPlanSource == LongitudinalPlanSource.lead1:
-      self.long_plan_source = "lead1"
-    elif long_plan.longitudinalPlanSource == LongitudinalPlanSource.lead2:
-      self.long_plan_source = "lead2"
-    elif long_plan.longitudinalPlanSource == LongitudinalPlanSource.e2e:
-      self.long_plan_source = "e2e"
-    else:
-      self.long_plan_source = "---"
-
-    if CP.sccBus != 0 and self.long_log:
-      str_log3 = 'LS={:s}  LP={:s}  AQ/FA={:+04.2f}/{:+04.2f}  GS={}  ED/RD={:04.1f}/{:04.1f}  TG={:04.2f}/{:+04.2f}'.format(self.long_stat, self.long_plan_source, CP.aqValue, final_accel, int(CS.gasPressed), dRel, CS.radarDistance, v_target, a_target)
-      trace1.printf2('{}'.format(str_log3))
-
-    return final_accel
+    output_accel = accel_min if output_accel < accel_min else (accel_max if output_accel > accel_max else output_accel)
+
+    self.long_stat = LongControl._STAT_MAP.get(self.long_control_state, "---")
+    self.long_plan_source = LongControl._SRC_MAP.get(long_plan.longitudinalPlanSource.raw, "---")
+
+    if cp.sccBus != 0 and self.long_log:
+      # only rebuild the log line when something worth showing changed, but publish it every tick
+      # since carcontroller overwrites the same message after controlsd has sent it
+      log_sig = (self.long_stat, self.long_plan_source, round(output_accel, 2))
+      if log_sig != self._last_log_sig:
+        self._last_log_sig = log_sig
+        self._long_log_line = (f'LS={self.long_stat:s}  LP={self.long_plan_source:s}  AQ/FA={CP.aqValue:+04.2f}/{output_accel:+04.2f}  '
+                               f'GS={int(gas_pressed)}  ED/RD={dRel:04.1f}/{CS.radarDistance:04.1f}  TG={v_target:04.2f}/{a_target:+04.2f}')
+      trace1.printf2(self._long_log_line)
+
+    return output_accel